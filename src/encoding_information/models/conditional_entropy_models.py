@@ -1,10 +1,22 @@
 from jax import jit
 import jax.numpy as np
+from functools import partial
+import numpy as onp
+import math
 import warnings
 
 from .model_base_class import MeasurementNoiseModel
 
 
+def _log(x):
+    """
+    math.log, but like np.log return -inf for 0 and nan for negative values instead of raising
+    """
+    if x > 0:
+        return math.log(x)
+    return -math.inf if x == 0 else math.nan
+
+
 class AnalyticGaussianNoiseModel(MeasurementNoiseModel):
     """
     Analytical model for estimating the conditional entropy H(Y | X) when the noise process
@@ -30,6 +42,8 @@ class AnalyticGaussianNoiseModel(MeasurementNoiseModel):
                              "sigma must be a single scalar value.")
         self.sigma = sigma
         self.num_channels = num_channels
+        # closed form, so it is computed once as a python float
+        self._conditional_entropy = num_channels * 0.5 * _log(2 * math.pi * math.e * float(sigma)**2)
 
     def estimate_conditional_entropy(self, images=None):
         """
@@ -49,7 +63,7 @@ class AnalyticGaussianNoiseModel(MeasurementNoiseModel):
         if images is not None:
             warnings.warn("The images argument is not used in the Analytic Gaussian noise model.")
         # Conditional entropy H(Y | X) for Gaussian noise
-        return self.num_channels * 0.5 * np.log(2 * np.pi * np.e * self.sigma**2)
+        return self._conditional_entropy
 
 class UniformNoiseModel(MeasurementNoiseModel):
     """ 
@@ -87,7 +101,7 @@ class UniformNoiseModel(MeasurementNoiseModel):
         if images is not None:
             warnings.warn("The images argument is not used in the Uniform noise model.")
         # Conditional entropy H(Y | X) for uniform noise
-        return np.log(self.range)
+        return _log(self.range)
 
 class PoissonNoiseModel(MeasurementNoiseModel):
     """
@@ -108,19 +122,27 @@ class PoissonNoiseModel(MeasurementNoiseModel):
         float
             The average conditional entropy per spatial pixel, computed using a Gaussian approximation. 
             For multichannel data (B, H, W, C) the per-channel contributions are summed so the result matches the
-            MultiChannelPixelCNN NLL convention (per spatial pixel).
+            MultiChannelPixelCNN NLL convention (per spatial pixel). This is in nats, like the measurement model NLLs
+            it is subtracted from, and the difference is converted to bits in estimate_information.
         """
         if len(images.shape) == 4:
             n_pixels = images.shape[-2] * images.shape[-3] # number of spatial pixels
         else:
             n_pixels = images.shape[-1] * images.shape[-2]
-        images = images.reshape(images.shape[0], -1) # flatten spatial (and channel) dimensions
-        
-        # Conditional entropy H(Y | x) for Poisson noise
-        gaussian_approx = 0.5 * (np.log(2 * np.pi * np.e) + np.log(images))
-        gaussian_approx = np.where(images <= 0, 0, gaussian_approx)
-        per_image_entropies = np.sum(gaussian_approx, axis=1) / n_pixels
-        return np.mean(per_image_entropies) # h(y|x) per pixel
+        return _poisson_conditional_entropy(images, n_pixels) # h(y|x) per pixel
+
+@partial(jit, static_argnums=(1,))
+def _poisson_conditional_entropy(images, n_pixels):
+    """
+    Gaussian approximation to the conditional entropy H(Y | x) for Poisson noise, summed over all the
+    values of each image (including channels), divided by n_pixels and averaged over images. Nonpositive 
+    values contribute 0. This is a single fused elementwise pass and reduction over all axes, so the images
+    are never reshaped. n_pixels is determined by the shape, so it is static and the divisor is a constant
+    """
+    positive = images > 0
+    # log of 1 on the nonpositive values, so nothing NaN is computed and then masked
+    gaussian_approx = np.where(positive, 0.5 * (math.log(2 * math.pi * math.e) + np.log(np.where(positive, images, 1))), 0)
+    return np.sum(gaussian_approx) / (images.shape[0] * n_pixels)
 
 
 class AnalyticComplexPixelGaussianNoiseModel(MeasurementNoiseModel):
@@ -134,10 +156,12 @@ class AnalyticComplexPixelGaussianNoiseModel(MeasurementNoiseModel):
         :param sigma_vec: Vector of standard deviations of the Gaussian noise at each pixel
         """
         self.sigma_vec = sigma_vec
-
-    def estimate_conditional_entropy(self, images=None):
         # input vector here if it's complex-valued items will be half the length of the vector used in the other computations. this has the number of complex-valued pixels. 
         # D log2 2 pi e + 2 sum log_2 sigma_i -> instead, computing here in log space because final MI computation will convert it to log2
-        constant_term = self.sigma_vec.shape[0] * np.log(2 * np.pi * np.exp(1))
-        sum_log_sigmas = 2 * np.sum(np.log(self.sigma_vec))
-        return constant_term + sum_log_sigmas
\ No newline at end of file
+        # this only depends on sigma_vec, so compute it once on the host
+        constant_term = sigma_vec.shape[0] * math.log(2 * math.pi * math.e)
+        sum_log_sigmas = 2 * onp.sum(onp.log(onp.asarray(sigma_vec, dtype=onp.float64)))
+        self._conditional_entropy = float(constant_term + sum_log_sigmas)
+
+    def estimate_conditional_entropy(self, images=None):
+        return self._conditional_entropy
\ No newline at end of file
@@ -1,9 +1,7 @@
 """
 Functions for computing and sampling from Gaussian processes    
 """
-from jax.scipy.linalg import toeplitz
 import jax.numpy as np
-from tqdm import tqdm
 import jax
 import matplotlib.pyplot as plt
 from jax import grad, jit
@@ -27,15 +25,22 @@ def match_to_generator_data(data, seed=None, add_uniform_noise=True):
     _, dataset_fn = make_dataset_generators(data, batch_size=data.shape[0], num_val_samples=data.shape[0], seed=seed, add_uniform_noise=add_uniform_noise)
     return next(dataset_fn())
 
-def estimate_full_cov_mat(patches):
+def estimate_full_cov_mat(patches, batch_size=2000):
     """
     Take an NxWxH stack of patches, and compute the covariance matrix of the vectorized patches
+
+    The outer products are accumulated over batches of batch_size patches, so only a batch of
+    centered patches is held in memory at a time.
+    This is a one-shot statistic, so it is computed with numpy on the host
     """
-    # patches = np.array(patches)
-    vectorized_patches = patches.reshape(patches.shape[0], -1).T
-    # center on 0
-    vectorized_patches = vectorized_patches - np.mean(vectorized_patches, axis=1, keepdims=True)
-    return np.cov(vectorized_patches).reshape(vectorized_patches.shape[0], vectorized_patches.shape[0])
+    vectorized_patches = onp.asarray(patches).reshape(patches.shape[0], -1)
+    mean = vectorized_patches.mean(axis=0)
+    cov_mat = onp.zeros((vectorized_patches.shape[1], vectorized_patches.shape[1]), dtype=vectorized_patches.dtype)
+    for start in range(0, vectorized_patches.shape[0], batch_size):
+        # center on 0
+        batch = vectorized_patches[start:start + batch_size] - mean
+        cov_mat += batch.T @ batch
+    return np.asarray(cov_mat / (vectorized_patches.shape[0] - 1))
 
 def plugin_estimate_stationary_cov_mat(patches, eigenvalue_floor, verbose=False, suppress_warning=False):
     cov_mat = estimate_full_cov_mat(patches)
@@ -47,30 +52,38 @@ def plugin_estimate_stationary_cov_mat(patches, eigenvalue_floor, verbose=False,
     if eigenvalue_floor is not None:
         if verbose:
             print('trying to make doubly toeplitz and positive definite')
-        # make positive definite
+        # make positive definite. This is the only eigendecomposition, the checks below
+        # just attempt a (much cheaper) Cholesky factorization
         eigvals, eig_vecs = np.linalg.eigh(stationary_cov_mat)
-        eigvals = np.where(eigvals < eigenvalue_floor, eigenvalue_floor, eigvals)
-        stationary_cov_mat = eig_vecs @ np.diag(eigvals) @ eig_vecs.T
-        while np.linalg.eigvalsh(stationary_cov_mat).min() < 0:
+        eigvals = np.maximum(eigvals, eigenvalue_floor)
+        stationary_cov_mat = (eig_vecs * eigvals) @ eig_vecs.T
+        while not _is_positive_definite(stationary_cov_mat):
             warnings.warn('Covariance matrix is not positive definite even after applying eigenvalue floor. This indicates numerical error.' +
                              'Try raising the eigenvalue floor than the current value of {}'.format(eigenvalue_floor))
             eigenvalue_floor *= 10
             print('trying eigenvalue floor of {}'.format(eigenvalue_floor))
-            eigvals = np.where(eigvals < eigenvalue_floor, eigenvalue_floor, eigvals)
-            stationary_cov_mat = eig_vecs @ np.diag(eigvals) @ eig_vecs.T
+            eigvals = np.maximum(eigvals, eigenvalue_floor)
+            stationary_cov_mat = (eig_vecs * eigvals) @ eig_vecs.T
         if verbose:
-            print('made positive definite, smallest ev: ' + str(np.linalg.eigvalsh(stationary_cov_mat).min()))
+            print('made positive definite, smallest ev: ' + str(eigvals.min()))
     
         doubly_toeplitz = average_diagonals_to_make_doubly_toeplitz(stationary_cov_mat, block_size, verbose=verbose)
-        dt_eigs = np.linalg.eigvalsh(doubly_toeplitz)
-        if np.any(dt_eigs < 0) and not suppress_warning:
+        if not suppress_warning and not _is_positive_definite(doubly_toeplitz):
             warnings.warn('Cannot make both doubly toeplitz and positive definite. Using positive definite matrix.'
-                          'Smallest eigenvalue is {}'.format(dt_eigs.min()))
+                          'Smallest eigenvalue is {}'.format(np.linalg.eigvalsh(doubly_toeplitz).min()))
 
 
     return stationary_cov_mat
 
 
+def _is_positive_definite(cov_mat):
+    """
+    Check positive definiteness by attempting a Cholesky factorization, which is much cheaper than
+    computing the eigenvalues. jax returns NaNs rather than raising when the factorization fails
+    """
+    return not np.any(np.isnan(np.linalg.cholesky(cov_mat)))
+
+
 def generate_multivariate_gaussian_samples(mean_vec, cov_mat, num_samples, seed=None, key=None):
     """
     Generate samples from a 2D gaussian process with the given covariance matrix
@@ -90,7 +103,104 @@ def generate_multivariate_gaussian_samples(mean_vec, cov_mat, num_samples, seed=
     return samples
 
 
-def _compute_stationary_log_likelihood(samples, cov_mat, mean, prefer_iterative=False, verbose=False, average=True):  
+def _conditioning_index(i, j, patch_size):
+    """
+    Index into the output of _precompute_conditional_distributions for the pixel at (i, j)
+    """
+    return min(i, patch_size - 1) * patch_size + min(j, patch_size - 1)
+
+
+def _pixels_to_condition(sample_size, patch_size, prefer_iterative=False):
+    """
+    Raster ordered (i, j) coordinates of the pixels that are evaluated or sampled conditioned on their window,
+    along with the _conditioning_index of each one. If prefer_iterative is False, the top left patch is
+    handled directly with the full covariance matrix and is skipped
+    """
+    pixel_coords = onp.array([(i, j) for i in range(sample_size) for j in range(sample_size)
+                              if prefer_iterative or i >= patch_size or j >= patch_size], dtype=int).reshape(-1, 2)
+    conditioning_indices = onp.array([_conditioning_index(i, j, patch_size) for i, j in pixel_coords], dtype=int)
+    return pixel_coords, conditioning_indices
+
+
+def _jittered_cholesky(cov_mat):
+    """
+    Lower Cholesky factor of cov_mat. In single precision a small diagonal jitter is added to keep 
+    the factorization stable. Contains NaNs if cov_mat is not positive definite
+    """
+    jitter = 1e-6 if cov_mat.dtype == np.float32 else 0.
+    return np.linalg.cholesky(cov_mat + jitter * np.eye(cov_mat.shape[0], dtype=cov_mat.dtype))
+
+
+@jit
+def _precompute_conditional_distributions(cholesky_factor):
+    """
+    Precompute the conditional variances and mean multipliers needed to evaluate or sample each pixel
+    of a stationary process conditioned on the previous pixels in its window.
+
+    Because the process is stationary, these only depend on where the pixel sits within the patch_size x patch_size
+    window it is conditioned on, i.e. on (min(i, patch_size - 1), min(j, patch_size - 1)), so there are only
+    patch_size**2 distinct cases no matter how big the samples are. Use _conditioning_index to look them up.
+
+    A pixel is conditioned on the rows above it and the pixels to its left, which are exactly the pixels
+    before it in raster order. So every case can be read off the Cholesky factor L of the full covariance 
+    matrix: the conditional variance of pixel k is L[k, k]**2 and its regression coefficients on the previous
+    pixels are -L[k, k] * inv(L)[k, :k], which takes one triangular inversion.
+
+    Mean multipliers cover the full vectorized window and are zero for pixels that are not conditioned on, 
+    so the conditional mean is just mean + (window - mean) @ mean_multipliers[index].
+
+    :param cholesky_factor: lower Cholesky factor of the covariance matrix of the process
+
+    :return: (patch_size**2,) array of variances and (patch_size**2, patch_size**2) array of mean multipliers
+    """
+    diag = np.diag(cholesky_factor)
+    cholesky_inverse = jax.scipy.linalg.solve_triangular(
+        cholesky_factor, np.eye(cholesky_factor.shape[0], dtype=cholesky_factor.dtype), lower=True)
+    mean_multipliers = -np.tril(cholesky_inverse, -1) * diag[:, None]
+    return diag ** 2, mean_multipliers
+
+
+def _conditional_pixel_log_likelihood(pixel_values, previous_values, mean_multiplier, variance, mean):
+    """
+    Log likelihood of one pixel position across a batch of samples, conditioned on the previous pixels
+
+    :param pixel_values: N array of the pixel value in each sample
+    :param previous_values: N x K array of the conditioning pixel values in each sample
+    :param mean_multiplier: K array mapping centered conditioning values to the conditional mean
+    :param variance: scalar conditional variance
+    :param mean: float mean of the process
+
+    :return: N array of log likelihoods
+    """
+    scale = np.sqrt(variance)
+    def single_sample(pixel_value, previous):
+        conditional_mean = mean + mean_multiplier @ (previous - mean)
+        return jax.scipy.stats.norm.logpdf(pixel_value, loc=conditional_mean, scale=scale)
+    return jax.vmap(single_sample)(pixel_values, previous_values)
+
+
+@partial(jit, static_argnums=(6,))
+def _conditional_log_likelihoods(samples, pixel_coords, conditioning_indices, mean_multipliers, variances, mean, patch_size):
+    """
+    Log likelihood of each pixel in pixel_coords conditioned on the previous pixels in its window. Since the 
+    conditioning values are observed, pixels don't depend on each other and all of them are evaluated
+    in a single compiled loop
+
+    :return: len(pixel_coords) x N array of log likelihoods
+    """
+    N_samples = samples.shape[0]
+    def single_pixel(coords_and_index):
+        (i, j), conditioning_index = coords_and_index
+        # get the relevant window of previous values
+        relevant_window = jax.lax.dynamic_slice(samples, (0, np.maximum(i - patch_size + 1, 0), np.maximum(j - patch_size + 1, 0)),
+                                                (N_samples, patch_size, patch_size))
+        return _conditional_pixel_log_likelihood(samples[:, i, j], relevant_window.reshape(N_samples, -1),
+                                                 mean_multipliers[conditioning_index], variances[conditioning_index], mean)
+    return jax.lax.map(single_pixel, ((pixel_coords[:, 0], pixel_coords[:, 1]), conditioning_indices))
+
+
+def _compute_stationary_log_likelihood(samples, cov_mat, mean, prefer_iterative=False, verbose=False, average=True,
+                                       dtype=np.float32, validate=True):  
     """
     Compute the log likelihood per pixel of a set of samples from a stationary process
 
@@ -100,6 +210,10 @@ def _compute_stationary_log_likelihood(samples, cov_mat, mean, prefer_iterative=
     :param prefer_iterative: if True, compute likelihood iteratively, otherwise compute directly if possible
     :param verbose: if True, print progress
     :param average: if True, return average log likelihood, otherwise return per example
+    :param dtype: floating point type to do the computation in. float32 is usually accurate enough and much
+        faster, but float64 can be used (with jax_enable_x64) for numerically delicate covariance matrices
+    :param validate: if True, check that the covariance matrix is positive definite. Callers that construct
+        it from clipped eigenvalues can skip this
 
     :return: average log_likelihood per pixel
     """
@@ -112,6 +226,9 @@ def _compute_stationary_log_likelihood(samples, cov_mat, mean, prefer_iterative=
         if np.unique(mean).size != 1:
             raise ValueError('Mean for stationary process cannot be an array with more than one unique value')
         mean = mean[0]
+    samples = np.asarray(samples, dtype=dtype)
+    cov_mat = np.asarray(cov_mat, dtype=dtype)
+    mean = np.asarray(mean, dtype=dtype)
         
     N_samples = samples.shape[0]
     # drop trailing channel dim
@@ -124,57 +241,13 @@ def _compute_stationary_log_likelihood(samples, cov_mat, mean, prefer_iterative=
         raise ValueError('Samples must be N x H x W, but got {}'.format(samples.shape))
     sample_size = samples.shape[1]
 
-    if np.linalg.eigvalsh(cov_mat).min() < 0:
+    if validate and not _is_positive_definite(cov_mat):
         raise ValueError('Covariance matrix is not positive definite')
+    # factor the covariance matrix once and reuse it for everything below
+    cholesky_factor = _jittered_cholesky(cov_mat)
     # precompute everything that will be the same for all samples
     patch_size = int(np.sqrt(cov_mat.shape[0]))
-    vectorized_masks = []
-    variances = []
-    mean_multipliers = []
-    iter = tqdm(np.arange(sample_size), desc='precomputing masks and variances') if verbose else np.arange(sample_size)
-    for i in iter:
-        for j in np.arange(sample_size):
-            if not prefer_iterative and i < patch_size and j < patch_size:
-                # Add placeholders since these get sampled from the covariance matrix directly
-                variances.append(None)
-                mean_multipliers.append(None)
-                vectorized_masks.append(None)
-            else:
-                top_part = np.ones((min(i, patch_size - 1), patch_size), dtype=bool)
-                left_part = np.ones((1, min(j, patch_size - 1)), dtype=bool)
-                right_part = np.zeros((1, patch_size - min(j, patch_size - 1)), dtype=bool)
-                bottom_part = np.zeros((patch_size - min(i, patch_size - 1) - 1, patch_size), dtype=bool)
-                middle_row = np.hstack((left_part, right_part))
-                conditioning_mask = np.vstack((top_part, middle_row, bottom_part))
-
-                vectorized_mask = conditioning_mask.reshape(-1)
-                vectorized_masks.append(vectorized_mask)
-                # find the linear index in the covariance matrix of the pixel we want to predict
-                pixel_to_predict_index = np.min(np.array([i, patch_size - 1])) * patch_size + np.min(np.array([j, patch_size - 1]))
-                sigma_11 = cov_mat[vectorized_mask][:, vectorized_mask].reshape(pixel_to_predict_index, pixel_to_predict_index) 
-                sigma_12 = cov_mat[vectorized_mask][:, pixel_to_predict_index].reshape(-1, 1)
-                sigma_21 = sigma_12.reshape(1, -1)
-                sigma_22 = cov_mat[pixel_to_predict_index, pixel_to_predict_index].reshape(1, 1)
-
-                
-                # more numerically stable
-                if i == 0 and j == 0:
-                    # top left pixel is not conditioned on anything
-                    variance = sigma_22 
-                    mean_multiplier = np.zeros((1, 1))
-                else:
-                    x = jax.scipy.linalg.solve(sigma_11, sigma_12)
-                    variance = (sigma_22 - sigma_21 @ x) 
-                    mean_multiplier = jax.scipy.linalg.solve(sigma_11, sigma_21.T)
-
-                # sigma11_inv = np.linalg.inv(sigma_11)
-                # variance = (sigma_22 - sigma_21 @ sigma11_inv @ sigma_12) 
-                # mean_multiplier = sigma_21 @ sigma11_inv 
-                variances.append(variance)
-                mean_multipliers.append(mean_multiplier)
-
-                if variances[-1] < 0:
-                    raise ValueError('Variance is negative {} {}'.format(i, j))
+    variances, mean_multipliers = _precompute_conditional_distributions(cholesky_factor)
 
     if verbose:
         print('evaluating likelihood')
@@ -183,48 +256,17 @@ def _compute_stationary_log_likelihood(samples, cov_mat, mean, prefer_iterative=
     if not prefer_iterative:
         # compute the log_likelihood to the top left image subpatch of the image directly
         top_left_subpatch = samples[:, :patch_size, :patch_size].reshape(N_samples, -1)
-        direct = []
-        for sample in top_left_subpatch:
-            direct.append(jax.scipy.stats.multivariate_normal.logpdf(sample.reshape(-1), mean=mean * np.ones(cov_mat.shape[0]), cov=cov_mat))
-        direct = np.array(direct)
-        log_likelihoods.append(direct)
-
-    iter = tqdm(np.arange(sample_size), desc='computing log likelihoods') if verbose else np.arange(sample_size)
-    for i in iter:
-        for j in np.arange(sample_size):
-
-            if not prefer_iterative and i < patch_size and j < patch_size :
-                # already did this
-                pass
-
-            # TODO: not sure this still works when the average parameter is set to False
-            elif i == 0 and j == 0:
-                # top left pixel is not conditioned on anything
-                variance = cov_mat[0, 0]
-                # compute likelihood of top left pixel
-                log_likelihoods.append(jax.scipy.stats.norm.logpdf(samples[:, i, j], loc=mean, scale=np.sqrt(variance)))
-            else:
-                vectorized_mask = vectorized_masks[i * sample_size + j]
-                # get the relevant window of previous values
-                relevant_window = samples[:, max(i - patch_size + 1, 0):max(i - patch_size + 1, 0) + patch_size, 
-                                                max(j - patch_size + 1, 0):max(j - patch_size + 1, 0) + patch_size]
-
-                previous_values = relevant_window.reshape(N_samples, -1)[:, vectorized_mask].reshape(N_samples, -1)
-                mean_to_use = mean + (mean_multipliers[i * sample_size + j].reshape(1, -1) @ (previous_values - mean).T).T
-                variance = variances[i * sample_size + j]
-                # print(variance)
-                # compute likelihood of pixel
-                # iterate over batch dimension
-                batch_likelihoods = []
-                
-                scale = np.sqrt(float(variance))
-                for k in np.arange(N_samples):
-                    mean_for_sample = mean_to_use[k]
-                    batch_likelihoods.append(jax.scipy.stats.norm.logpdf(samples[k, i, j], loc=mean_for_sample, scale=scale))                    
-                log_likelihoods.append(np.array(batch_likelihoods).flatten())
+        direct = _gaussian_likelihood_from_cholesky(cholesky_factor, np.full(cov_mat.shape[0], mean, dtype=dtype), top_left_subpatch)
+        log_likelihoods.append(direct[None])
+
+    # TODO: not sure this still works when the average parameter is set to False
+    pixel_coords, conditioning_indices = _pixels_to_condition(sample_size, patch_size, prefer_iterative=prefer_iterative)
+    if pixel_coords.shape[0] > 0:
+        log_likelihoods.append(_conditional_log_likelihoods(samples, np.asarray(pixel_coords), np.asarray(conditioning_indices),
+                                                            mean_multipliers, variances, mean, patch_size))
 
     # return average log likelihood per pixel
-    log_likelihoods = np.array(log_likelihoods) / cov_mat.shape[0]
+    log_likelihoods = np.concatenate(log_likelihoods, axis=0) / cov_mat.shape[0]
     if average:
         return np.mean(log_likelihoods)
     return log_likelihoods.flatten()
@@ -232,7 +274,8 @@ def _compute_stationary_log_likelihood(samples, cov_mat, mean, prefer_iterative=
 
 def generate_stationary_gaussian_process_samples(mean_vec, cov_mat, num_samples, sample_size=None,
                                                  ensure_nonnegative=False,
-                                                 prefer_iterative_sampling=False, seed=None, verbose=False):
+                                                 prefer_iterative_sampling=False, seed=None, verbose=False,
+                                                 dtype=np.float32, validate=True):
     """
     Given a covariance matrix of a stationary Gaussian process, generate samples from it. If the sample_size
     is less than or equal to the patch size used to generate the covariance matrix, this will be relatively
@@ -252,15 +295,23 @@ def generate_stationary_gaussian_process_samples(mean_vec, cov_mat, num_samples,
         This is much slower
     seed : int , seed for the random number generator
     verbose : bool if true, print progress
+    dtype : floating point type to sample in. float32 is usually accurate enough and much faster, but 
+        float64 can be used (with jax_enable_x64) for numerically delicate covariance matrices
+    validate : bool if true, check that the covariance matrix is positive definite. Callers that construct
+        it from clipped eigenvalues can skip this
     """
+    mean_vec = np.asarray(mean_vec, dtype=dtype)
+    cov_mat = np.asarray(cov_mat, dtype=dtype)
     if sample_size is None:
         sample_size = int(np.sqrt(cov_mat.shape[0]))
-    if np.linalg.eigvalsh(cov_mat).min() < 0:
+    if validate and not _is_positive_definite(cov_mat):
         raise ValueError('Covariance matrix is not positive definite')
     key = jax.random.PRNGKey(onp.random.randint(0, 100000) if seed is None else seed)
     # Use jax to do it all at once if possible
     if not prefer_iterative_sampling and sample_size <= int(np.sqrt(cov_mat.shape[0])):
         samples = jax.random.multivariate_normal(key, mean_vec, cov_mat, shape=(num_samples,))
+        patch_size = int(np.sqrt(cov_mat.shape[0]))
+        samples = samples.reshape(num_samples, patch_size, patch_size)
         # crop if needed
         if sample_size < int(np.sqrt(cov_mat.shape[0])):
             samples = samples[:, :sample_size, :sample_size]
@@ -268,167 +319,150 @@ def generate_stationary_gaussian_process_samples(mean_vec, cov_mat, num_samples,
             samples = np.where(samples < 0, 0, samples)
         return samples.reshape(num_samples, sample_size, sample_size)
     # precompute everything that will be the same for all samples
-    patch_size = int(np.sqrt(cov_mat.shape[0]))
-    vectorized_masks = []
-    variances = []
-    mean_multipliers = []
-    iter = tqdm(np.arange(sample_size), desc='precomputing masks and variances') if verbose else np.arange(sample_size)
-    for i in iter:
-        for j in np.arange(sample_size):
-            if not prefer_iterative_sampling and i < patch_size and j < patch_size:
-                # raise Exception('why is there a -1 here? double check')
-
-                # Add placeholders since these get sampled from the covariance matrix directly
-                variances.append(None)
-                mean_multipliers.append(None)
-                vectorized_masks.append(None)
-            else:
-                top_part = np.ones((min(i, patch_size - 1), patch_size), dtype=bool)
-                left_part = np.ones((1, min(j, patch_size - 1)), dtype=bool)
-                right_part = np.zeros((1, patch_size - min(j, patch_size - 1)), dtype=bool)
-                bottom_part = np.zeros((patch_size - min(i, patch_size - 1) - 1, patch_size), dtype=bool)
-                middle_row = np.hstack((left_part, right_part))
-                conditioning_mask = np.vstack((top_part, middle_row, bottom_part))
-
-                vectorized_mask = conditioning_mask.reshape(-1)
-                vectorized_masks.append(vectorized_mask)
-                # find the linear index in the covariance matrix of the pixel we want to predict
-                pixel_to_predict_index = np.min(np.array([i, patch_size - 1])) * patch_size + np.min(np.array([j, patch_size - 1]))
-                sigma_11 = cov_mat[vectorized_mask][:, vectorized_mask].reshape(pixel_to_predict_index, pixel_to_predict_index) 
-                sigma_12 = cov_mat[vectorized_mask][:, pixel_to_predict_index].reshape(-1, 1)
-                sigma_21 = sigma_12.reshape(1, -1)
-                sigma_22 = cov_mat[pixel_to_predict_index, pixel_to_predict_index].reshape(1, 1)
-
-                # more numerically stable
-                if i == 0 and j == 0:
-                    # top left pixel is not conditioned on anything
-                    variance = sigma_22 
-                    mean_multiplier = np.zeros((1, 1))
-                else:
-                    x = jax.scipy.linalg.solve(sigma_11, sigma_12)
-                    variance = (sigma_22 - sigma_21 @ x) 
-                    mean_multiplier = jax.scipy.linalg.solve(sigma_11, sigma_21.T)
-
-                # sigma11_inv = np.linalg.inv(sigma_11)
-                # variance = (sigma_22 - sigma_21 @ sigma11_inv @ sigma_12) 
-                # mean_multiplier = sigma_21 @ sigma11_inv 
-                
-                variances.append(variance)
-                mean_multipliers.append(mean_multiplier)
-
-
-                if variances[-1] < 0:
-                    raise ValueError('Variance is negative {} {}'.format(i, j))
-
+    variances, mean_multipliers = _precompute_conditional_distributions(_jittered_cholesky(cov_mat))
 
     if verbose:
         print('generating stationary gaussian process samples')
-    samples = _generate_samples(num_samples, cov_mat, mean_vec, key, sample_size, vectorized_masks, variances, 
-                                    mean_multipliers, prefer_iterative_sampling=prefer_iterative_sampling, verbose=verbose)
+    samples = _generate_samples(num_samples, cov_mat, mean_vec, key, sample_size, variances, mean_multipliers, 
+                                prefer_iterative_sampling=prefer_iterative_sampling, verbose=verbose, dtype=dtype)
     if ensure_nonnegative:
         samples = np.where(samples < 0, 0, samples)
     
     return samples
 
-def _generate_samples(num_samples, cov_mat, mean_vec, key, sample_size, vectorized_masks, variances, 
-                      mean_multipliers, prefer_iterative_sampling=False, verbose=False):
+def _generate_samples(num_samples, cov_mat, mean_vec, key, sample_size, variances, mean_multipliers, 
+                      prefer_iterative_sampling=False, verbose=False, dtype=np.float32):
+    cov_mat = np.asarray(cov_mat, dtype=dtype)
+    mean_vec = np.asarray(mean_vec, dtype=dtype)
     patch_size = int(np.sqrt(cov_mat.shape[0]))
     if not prefer_iterative_sampling:
         # sample the first (patch_size, patch_size) pixels directly from the covariance matrix
         sampled_images = generate_multivariate_gaussian_samples(mean_vec, cov_mat, num_samples, key=key)
+        sampled_images = sampled_images.reshape(num_samples, patch_size, patch_size)
+        key = jax.random.split(key)[1]
 
         # if the directly sampled image is sufficiently large for the sample size requested, return it
-        if sampled_images.shape[1] == sample_size:
+        if sampled_images.shape[-1] == sample_size:
             return sampled_images
-        elif sampled_images.shape[1] > sample_size:
+        elif sampled_images.shape[-1] > sample_size:
             return sampled_images[..., :sample_size, :sample_size]
 
         # pad the right and bottom with zeros
         sampled_images = np.pad(sampled_images, ((0, 0), (0, sample_size - sampled_images.shape[-2]), (0, sample_size - sampled_images.shape[-1])))
     else:
-        sampled_images = np.zeros((num_samples, sample_size, sample_size))
-
-    iter = tqdm(np.arange(sample_size), desc='generating samples') if verbose else np.arange(sample_size)
-    for i in iter:
-        for j in np.arange(sample_size):
-            if not prefer_iterative_sampling and i < patch_size  and j < patch_size :
-                # raise Exception('why is there a -1 here? double check')
-                # use existing values
-                pass
-            elif i == 0 and j == 0:
-                # top left pixel is not conditioned on anything                
-                samples = jax.random.normal(key, shape=(num_samples,)) * np.sqrt(cov_mat[0, 0]) + mean_vec[0]
-                sampled_images = sampled_images.at[:, i, j].set(samples)
-                key = jax.random.split(key)[1]
-            else:
-                vectorized_mask = vectorized_masks[i * sample_size + j]
-                # get the relevant window of previous values
-                relevant_window = sampled_images[..., 
-                                                max(i - patch_size + 1, 0):max(i - patch_size + 1, 0) + patch_size, 
-                                                max(j - patch_size + 1, 0):max(j - patch_size + 1, 0) + patch_size]
-                previous_values = relevant_window.reshape(num_samples, -1)[:, vectorized_mask].reshape(num_samples, vectorized_mask.sum(), 1)
-                
-                mean = (mean_multipliers[i * sample_size + j].reshape(1, -1) @ (previous_values - mean_vec[0]) + mean_vec[0]).flatten()
-                variance = variances[i * sample_size + j]
-                samples = (jax.random.normal(key, shape=(num_samples,)) * np.sqrt(variance) + mean)
-                sampled_images = sampled_images.at[:, i, j].set(samples.flatten())
-                key = jax.random.split(key)[1]
-            
+        sampled_images = np.zeros((num_samples, sample_size, sample_size), dtype=dtype)
+
+    if verbose:
+        print('sampling {} rows sequentially'.format(sample_size))
+    # in rows that overlap the directly sampled patch, start sampling to the right of it
+    first_column = 0 if prefer_iterative_sampling else patch_size
+    return _sample_rows_sequentially(sampled_images, key, mean_multipliers, variances, mean_vec[0], patch_size, first_column)
+
+
+@partial(jit, static_argnums=(5, 6))
+def _sample_rows_sequentially(sampled_images, key, mean_multipliers, variances, mean, patch_size, first_column):
+    """
+    Sample the pixels of each row conditioned on the previously sampled pixels in their window. This scans 
+    over rows, drawing the noise for a whole row at once, and loops over the pixels within a row, since each 
+    pixel is conditioned on the one to its left. The compiled graph does not grow with the number of pixels
+
+    :param first_column: column to start sampling at in the first patch_size rows, so that a directly
+        sampled top left patch is kept
+    """
+    num_samples, sample_size = sampled_images.shape[0], sampled_images.shape[-1]
+
+    def sample_row(sampled_images, i):
+        noise = jax.random.normal(jax.random.fold_in(key, i), shape=(sample_size, num_samples), dtype=sampled_images.dtype)
+        window_start_i = np.maximum(i - patch_size + 1, 0)
+
+        def sample_pixel(j, sampled_images):
+            conditioning_index = np.minimum(i, patch_size - 1) * patch_size + np.minimum(j, patch_size - 1)
+            # get the relevant window of previous values
+            relevant_window = jax.lax.dynamic_slice(sampled_images, (0, window_start_i, np.maximum(j - patch_size + 1, 0)), 
+                                                    (num_samples, patch_size, patch_size))
+            conditional_mean = mean + (relevant_window.reshape(num_samples, -1) - mean) @ mean_multipliers[conditioning_index]
+            samples = noise[j] * np.sqrt(variances[conditioning_index]) + conditional_mean
+            return jax.lax.dynamic_update_slice(sampled_images, samples.reshape(num_samples, 1, 1), (0, i, j))
+
+        start = np.where(i < patch_size, first_column, 0)
+        return jax.lax.fori_loop(start, sample_size, sample_pixel, sampled_images), None
+
+    sampled_images, _ = jax.lax.scan(sample_row, sampled_images, np.arange(sample_size))
     return sampled_images
-    
+
 
 #####################################################
 ####### Optimizing a stationary gaussian fit ########
 #####################################################
 @partial(jit, static_argnums=(1, 2))
 def average_diagonals_to_make_doubly_toeplitz(cov_mat, patch_size, verbose=False):
-    # divide it into blocks
-    blocks = [np.hsplit(row, cov_mat.shape[1]//patch_size) for row in np.vsplit(cov_mat, cov_mat.shape[0]//patch_size)]
-
-    toeplitz_blocks = {}
-    for i in range(len(blocks)):
-        for j in range(len(blocks[0])):
-            id = (i - j)
-            if id not in toeplitz_blocks:
-                toeplitz_blocks[id] = []
-            toeplitz_blocks[id].append(blocks[i][j])
+    """
+    Average a (B*P x B*P) covariance matrix of vectorized P x P patches along its block diagonals and 
+    then along the diagonals within each block, producing a doubly toeplitz matrix. This is done with
+    reshapes and segment sums, so the traced graph does not grow with the number of blocks
+    """
+    return _doubly_toeplitz_from_generator(_doubly_toeplitz_generator(cov_mat, patch_size))
 
-    # compute the mean of each block
-    toeplitz_block_means = {id: np.mean(np.stack(blocks, axis=0), axis=0) for id, blocks in toeplitz_blocks.items()}
+def _doubly_toeplitz_generator(cov_mat, patch_size):
+    """
+    Compute the (B x P) generator of the symmetric doubly toeplitz matrix closest to cov_mat. Entry [b, d] 
+    is the average of the d-th diagonal of the blocks on the b-th block diagonal, and together these
+    values determine every entry of the (B*P x B*P) matrix
+    """
+    num_blocks = cov_mat.shape[0] // patch_size
+    # (block row, block col, row within block, col within block)
+    blocks = cov_mat.reshape(num_blocks, patch_size, num_blocks, patch_size).transpose(0, 2, 1, 3)
+
+    # compute the mean of the blocks along each block diagonal. The lower block diagonals
+    # (block row >= block col) are used for both halves of the symmetric result
+    block_i, block_j = np.meshgrid(np.arange(num_blocks), np.arange(num_blocks), indexing='ij')
+    block_offsets = (block_i - block_j).reshape(-1)
+    lower = block_offsets >= 0
+    block_sums = jax.ops.segment_sum(np.where(lower[:, None, None], blocks.reshape(-1, patch_size, patch_size), 0),
+                                     np.where(lower, block_offsets, 0), num_segments=num_blocks)
+    block_counts = jax.ops.segment_sum(lower.astype(cov_mat.dtype), np.where(lower, block_offsets, 0), num_segments=num_blocks)
+    toeplitz_block_means = block_sums / block_counts[:, None, None]
 
     # now repeat the process within each block
-    j, i = np.meshgrid(np.arange(patch_size), np.arange(patch_size))
+    i, j = np.meshgrid(np.arange(patch_size), np.arange(patch_size), indexing='ij')
     differences = abs(i - j)
-    for block_id, block in tqdm(dict(toeplitz_block_means.items()).items(), desc='building toeplitz mat') if verbose else dict(toeplitz_block_means.items()).items():
-        diag_values = []
-        for id in np.arange(patch_size):
-            # recompute mask each time to save memory
-            mask = differences == id
-            diag_values.append(np.sum(np.where(mask, block, 0)) / np.sum(mask))            
-        # create a new topelitz matrix from the diagonal values
-        toeplitz_block_means[block_id] = toeplitz(np.array(diag_values))
-
-    # now reconstruct the full doubly toeplitz matrix from the blocks
-    new_blocks = []
-    for i in range(len(blocks)):
-        row = []
-        for j in range(len(blocks[0])):
-            id = abs(i - j)
-            row.append(toeplitz_block_means[id])
-        new_blocks.append(np.hstack(row))
-    doubly_toeplitz = np.vstack(new_blocks)
-    return doubly_toeplitz
+    diag_sums = jax.ops.segment_sum(toeplitz_block_means.reshape(num_blocks, -1).T, differences.reshape(-1), num_segments=patch_size)
+    diag_counts = np.bincount(differences.reshape(-1), length=patch_size)
+    return (diag_sums / diag_counts[:, None]).T
 
+def _doubly_toeplitz_from_generator(generator):
+    """
+    Materialize the dense (B*P x B*P) doubly toeplitz matrix from its (B x P) generator
+    """
+    num_blocks, patch_size = generator.shape
+    i, j = np.meshgrid(np.arange(patch_size), np.arange(patch_size), indexing='ij')
+    block_i, block_j = np.meshgrid(np.arange(num_blocks), np.arange(num_blocks), indexing='ij')
+    toeplitz_blocks = generator[:, abs(i - j)]
+    doubly_toeplitz = toeplitz_blocks[abs(block_i - block_j)]
+    size = num_blocks * patch_size
+    return doubly_toeplitz.transpose(0, 2, 1, 3).reshape(size, size)
+
+@jit
 def gaussian_likelihood(cov_mat, mean_vec, batch):
     """
     Evaluate the log likelihood of a multivariate gaussian
     for a batch of NxWXH samples.
+
+    The Cholesky factor of the covariance matrix is computed once and the whole
+    batch is whitened with a single triangular solve.
     """
-    log_likelihoods = []
-    for sample in batch:
-        ll = jax.scipy.stats.multivariate_normal.logpdf(sample.reshape(-1), mean=mean_vec, cov=cov_mat)
-        log_likelihoods.append(ll)
-    return np.array(log_likelihoods)
+    return _gaussian_likelihood_from_cholesky(np.linalg.cholesky(cov_mat), mean_vec, batch)
+
+@jit
+def _gaussian_likelihood_from_cholesky(cholesky_factor, mean_vec, batch):
+    """
+    Evaluate the log likelihood of a multivariate gaussian, given the lower Cholesky factor
+    of its covariance matrix, for a batch of NxWXH samples.
+    """
+    centered = batch.reshape(batch.shape[0], -1) - mean_vec
+    z = jax.scipy.linalg.solve_triangular(cholesky_factor, centered.T, lower=True)
+    log_det = 2 * np.sum(np.log(np.diag(cholesky_factor)))
+    return -0.5 * (cholesky_factor.shape[0] * np.log(2 * np.pi) + log_det + np.sum(z ** 2, axis=0))
 
 def nll_per_pixel_from_cov_mat(cov_mat, mean_vec, data, num_pixels):
     """
@@ -438,10 +472,31 @@ def nll_per_pixel_from_cov_mat(cov_mat, mean_vec, data, num_pixels):
     nll = -np.mean(ll) # average over batch
     return nll / num_pixels
 
+def gaussian_likelihood_from_eigendecomposition(eig_vals, eig_vecs, mean_vec, batch):
+    """
+    Evaluate the log likelihood of a multivariate gaussian with covariance matrix
+    eig_vecs @ diag(eig_vals) @ eig_vecs.T for a batch of NxWXH samples, without
+    forming or factorizing the covariance matrix.
+    """
+    centered = batch.reshape(batch.shape[0], -1) - mean_vec
+    projected = centered @ eig_vecs
+    log_det = np.sum(np.log(eig_vals))
+    return -0.5 * (eig_vals.size * np.log(2 * np.pi) + log_det + np.sum(projected ** 2 / eig_vals, axis=1))
+
+def nll_per_pixel_from_eigendecomposition(eig_vals, eig_vecs, mean_vec, data, num_pixels):
+    """
+    Negative log likelihood of a multivariate gaussian per pixel, parameterized by the
+    eigendecomposition of its covariance matrix
+    """
+    ll = gaussian_likelihood_from_eigendecomposition(eig_vals, eig_vecs, mean_vec, data)
+    nll = -np.mean(ll) # average over batch
+    return nll / num_pixels
+
 def make_positive_definite(cov_mat, eigenvalue_floor):
     eigvals, eig_vecs = np.linalg.eigh(cov_mat)
-    eigvals = np.where(eigvals < eigenvalue_floor, eigenvalue_floor, eigvals)
-    return eig_vecs @ np.diag(eigvals) @ eig_vecs.T
+    eigvals = np.maximum(eigvals, eigenvalue_floor)
+    # scaling the columns is the same as multiplying by diag(eigvals), but without the extra matmul
+    return (eig_vecs * eigvals) @ eig_vecs.T
 
 def try_to_make_doubly_toeplitz_and_positive_definite(eigvals, eig_vecs, eigenvalue_floor, patch_size):
     """
@@ -450,11 +505,14 @@ def try_to_make_doubly_toeplitz_and_positive_definite(eigvals, eig_vecs, eigenva
     eigenvalue_floor to eigenvalue_floor to get rid of negative eigenvalues.
 
     This won't neccesarily return a doubly toeplitz matrix, but it will be positive definite.
+
+    The dense matrix is only formed for the averaging step, and the clipped eigenvalues and 
+    eigenvectors of the averaged matrix are returned.
     """
-    cov_mat = eig_vecs @ np.diag(eigvals) @ eig_vecs.T
+    cov_mat = (eig_vecs * eigvals) @ eig_vecs.T
     dt_cov_mat = average_diagonals_to_make_doubly_toeplitz(cov_mat, patch_size)
     eigvals, eig_vecs = np.linalg.eigh(dt_cov_mat)
-    eigvals = np.where(eigvals < eigenvalue_floor, eigenvalue_floor, eigvals)
+    eigvals = np.maximum(eigvals, eigenvalue_floor)
     return eigvals, eig_vecs
 
  
@@ -473,17 +531,18 @@ class _StationaryGaussianProcessFlaxImpl(nn.Module):
 
     def __call__(self):
         """
-        return the mean and covariance matrix of the Gaussian process as a function of the optimizable parameters
+        return the mean and the eigendecomposition of the covariance matrix of the Gaussian process 
+        as a function of the optimizable parameters
         """
-        cov_mat = self.eig_vecs @ np.diag(self.eig_vals) @ self.eig_vecs.T
-        return self.mean_vec, cov_mat
+        return self.mean_vec, self.eig_vals, self.eig_vecs
     
 
-    def compute_loss(self, mean_vec, cov_mat, images):
+    def compute_loss(self, mean_vec, eig_vals, eig_vecs, images):
         """ 
-        Compute average negative log likelihood per pixel averaged over batch
+        Compute average negative log likelihood per pixel averaged over batch. This works directly
+        with the eigendecomposition so the covariance matrix never needs to be reconstructed or factorized
         """
-        return nll_per_pixel_from_cov_mat(cov_mat, mean_vec, images, np.prod(np.array(images.shape[1:])))
+        return nll_per_pixel_from_eigendecomposition(eig_vals, eig_vecs, mean_vec, images, np.prod(np.array(images.shape[1:])))
 
 
 ##################################################################################################
@@ -687,20 +746,21 @@ class StationaryGaussianProcess(MeasurementModel):
             warnings.warn('seed argument is deprecated. Use data_seed instead')
             data_seed = seed
         eig_vals, eig_vecs, mean_vec = self._get_current_params()
-        cov_mat = eig_vecs @ np.diag(eig_vals) @ eig_vecs.T
+        cov_mat = (eig_vecs * eig_vals) @ eig_vecs.T
         
-        while np.linalg.eigvalsh(cov_mat).min() < 0:
+        while not _is_positive_definite(cov_mat):
             if eig_vals.min() <= 0:
                 raise ValueError('Covariance matrix is not positive definite. This should not have happened')
             warnings.warn('Covariance matrix does not retain positive definiteness after after eigenvalue decomposition and recomposition. '
                     'This likely indicates numerical error. Trying to boost the smallest EVs to fix this.')
             floor = eig_vals.min() * 2
             eig_vals = np.where(eig_vals < floor, floor, eig_vals)
-            cov_mat = eig_vecs @ np.diag(eig_vals) @ eig_vecs.T
+            cov_mat = (eig_vecs * eig_vals) @ eig_vecs.T
             
         images = match_to_generator_data(images, seed=data_seed)
 
-        lls = _compute_stationary_log_likelihood(images, cov_mat, mean_vec, verbose=verbose, average=average)
+        # positive definiteness was already ensured above
+        lls = _compute_stationary_log_likelihood(images, cov_mat, mean_vec, verbose=verbose, average=average, validate=False)
         return -lls
     
         
@@ -727,14 +787,16 @@ class StationaryGaussianProcess(MeasurementModel):
             Generated image samples.
         """
         eig_vals, eig_vecs, mean_vec = self._get_current_params()
-        cov_mat = eig_vecs @ np.diag(eig_vals) @ eig_vecs.T
+        cov_mat = (eig_vecs * eig_vals) @ eig_vecs.T
+        # the eigenvalues are clipped to be positive, so no need to check the reconstruction
         samples = generate_stationary_gaussian_process_samples( 
-                    mean_vec, cov_mat, num_samples, sample_shape, ensure_nonnegative=ensure_nonnegative, seed=seed, verbose=verbose)
+                    mean_vec, cov_mat, num_samples, sample_shape, ensure_nonnegative=ensure_nonnegative, seed=seed, 
+                    verbose=verbose, validate=False)
         return samples
 
     def get_cov_mat(self):
         eig_vals, eig_vecs, mean_vec = self._get_current_params()
-        cov_mat = eig_vecs @ np.diag(eig_vals) @ eig_vecs.T
+        cov_mat = (eig_vecs * eig_vals) @ eig_vecs.T
         return cov_mat
 
     def get_mean_vec(self):
@@ -4,6 +4,7 @@ Functions for helping with complicated plots
 
 from cleanplots import *
 import numpy as np
+from functools import lru_cache
 from tqdm import tqdm
 from matplotlib.colors import LinearSegmentedColormap
 import matplotlib
@@ -30,29 +31,36 @@ def plot_samples(samples, ground_truth, model_names=['Samples'], contrast_cutoff
         Directory to save the plot.
     """
 
-    vmin, vmax = np.percentile(ground_truth.flatten()[:5000], 100 - contrast_cutoff), np.percentile(ground_truth.flatten()[:5000], contrast_cutoff)
+    vmin, vmax = np.percentile(ground_truth.reshape(-1)[:5000], [100 - contrast_cutoff, contrast_cutoff])
 
     if type(samples) is not list:
         samples = [samples]
 
-    fig, axs = plt.subplots(len(samples) + 1, num_images, figsize=(2.5*num_images, 2*(len(samples)+1)))
-    
-    for row_index, model_samples in enumerate(samples):
-        for i, ax in enumerate(axs[row_index]):
-            ax.imshow(model_samples[i], cmap='inferno', vmin=vmin, vmax=vmax)
-            ax.axis('off')
-
-    # plot ground truth
-    for i, ax in enumerate(axs[-1]):
-        ax.imshow(ground_truth[i], cmap='inferno', vmin=vmin, vmax=vmax)
+    # each row is a single image of the tiled samples
+    fig, axs = plt.subplots(len(samples) + 1, 1, figsize=(2.5*num_images, 2*(len(samples)+1)), squeeze=False)
+    axs = axs[:, 0]
+
+    for ax, images in zip(axs, samples + [ground_truth]):
+        ax.imshow(_tile_images(images, num_images), cmap='inferno', vmin=vmin, vmax=vmax)
         ax.axis('off')
 
-    # set y labels to left of each row by adding new axes
-    for i, (ax, name) in enumerate(zip(axs[:, 0], model_names + ['Ground Truth'])):
-        ax.text(-0.1, 0.5, name,  transform=ax.transAxes, rotation=90, va='center', ha='center')
+    # set y labels to left of each row
+    for ax, name in zip(axs, model_names + ['Ground Truth']):
+        ax.text(-0.1 / num_images, 0.5, name,  transform=ax.transAxes, rotation=90, va='center', ha='center')
     if save_dir is not None:
         plt.savefig(save_dir + 'samples.png', bbox_inches='tight')
 
+def _tile_images(images, num_images):
+    """
+    Concatenate the first num_images images side by side, separated by NaN columns that display as blank gaps
+    """
+    images = [np.asarray(images[i], dtype=float) for i in range(num_images)]
+    gap = np.full((images[0].shape[0], max(1, images[0].shape[1] // 10)), np.nan)
+    tiles = [images[0]]
+    for image in images[1:]:
+        tiles += [gap, image]
+    return np.concatenate(tiles, axis=1)
+
 def plot_optimization_loss_history(val_loss_history):
     """
     Plot the validation loss history during an optimization process.
@@ -104,9 +112,13 @@ def plot_eigenvalues(*args, **kwargs):
     
     for i, arg in enumerate(args):
         kwargs[f'{i}'] = arg
-    for name in kwargs.keys():
-        cov_mat = kwargs[name]
-        eig_vals = np.linalg.eigvalsh(cov_mat)
+    cov_mats = [np.asarray(cov_mat) for cov_mat in kwargs.values()]
+    if len(set(cov_mat.shape for cov_mat in cov_mats)) == 1:
+        # same shapes, so compute all the eigenvalues in one batched call
+        all_eig_vals = np.linalg.eigvalsh(np.stack(cov_mats))
+    else:
+        all_eig_vals = [np.linalg.eigvalsh(cov_mat) for cov_mat in cov_mats]
+    for name, eig_vals in zip(kwargs.keys(), all_eig_vals):
         axs.semilogy(eig_vals, '.-', label=name)
     axs.legend()
     clear_spines(axs)
@@ -146,23 +158,24 @@ def plot_intensity_coord_histogram(ax, intensities_1, intensities_2, max,  cmap=
         Additional keyword arguments passed to the plotting functions.
     """
     # make sure they are N groups x num samples
-    intensities_1 = np.array(intensities_1)
-    intensities_2 = np.array(intensities_2)
+    intensities_1 = np.asarray(intensities_1)
+    intensities_2 = np.asarray(intensities_2)
     intensities_1 = intensities_1.reshape(-1, intensities_1.shape[-1])
     intensities_2 = intensities_2.reshape(-1, intensities_2.shape[-1])
 
     if colors is None and color is None:
         colors = get_color_cycle()
 
+    # the bin edges are shared by all the histograms, which are raw counts normalized by their max
     bins = np.linspace(0, max, bins)
     hists = []  
     cmaps = []
     cmaps_white = []
     if cmap is not None:
         cmaps.append(cmap)
-        hist, xedges, yedges = np.histogram2d(intensities_2.ravel(), intensities_1.ravel(), bins=bins, density=True)
+        hist, xedges, yedges = np.histogram2d(intensities_2.ravel(), intensities_1.ravel(), bins=bins)
         hist = hist / np.max(hist)
-        ax.imshow(cmap(hist), origin='lower', extent=[xedges[0], xedges[-1], yedges[0], yedges[-1]])
+        ax.imshow(_lookup_colors(cmap, hist), origin='lower', extent=[xedges[0], xedges[-1], yedges[0], yedges[-1]])
         # plot a center point circle
         if plot_center_coords is not None:
             for center_coord in plot_center_coords:
@@ -174,37 +187,43 @@ def plot_intensity_coord_histogram(ax, intensities_1, intensities_2, max,  cmap=
 
     else:
         for sample_points_1, sample_points_2, i in zip(intensities_1, intensities_2, range(intensities_1.shape[0])):
-            hist, xedges, yedges = np.histogram2d(sample_points_2, sample_points_1, bins=bins, density=True)
+            hist, xedges, yedges = np.histogram2d(sample_points_2, sample_points_1, bins=bins)
             hists.append(hist)
             if color is None or i == 0:
         
                 if not black_background:
                     if colors is not None:
-                        cmaps.append(LinearSegmentedColormap.from_list(f'cmap{i}', [(1,1,1), colors[i]]))
+                        cmaps.append(_make_cmap(f'cmap{i}', (1, 1, 1), colors[i]))
                     else:
-                        cmaps.append( LinearSegmentedColormap.from_list(f'cmap{i}', [(1,1,1), color]))
+                        cmaps.append( _make_cmap(f'cmap{i}', (1, 1, 1), color))
                 else:
                     if colors is not None:
-                        cmaps.append(LinearSegmentedColormap.from_list(f'cmap{i}', [(0, 0, 0, 0), colors[i]]))
-                        cmaps_white.append(LinearSegmentedColormap.from_list(f'cmap{i}', [(1, 1, 1), colors[i]]))
+                        cmaps.append(_make_cmap(f'cmap{i}', (0, 0, 0, 0), colors[i]))
+                        cmaps_white.append(_make_cmap(f'cmap{i}', (1, 1, 1), colors[i]))
                     else:
-                        cmaps.append( LinearSegmentedColormap.from_list(f'cmap{i}', [(0,0,0, 0), color]))
+                        cmaps.append( _make_cmap(f'cmap{i}', (0, 0, 0, 0), color))
 
         # Compute the color of each bin by blending the colors from the two colormaps
         # loop over all histograms and colormaps
         hists = [hist / np.max(hist) for hist in hists]
+        # colors are looked up from each colormap's table and reduced in place
         if len(cmaps) > 1:
             if not black_background:
                 # blended_color = np.min(np.stack([cmap(hist) for cmap, hist in zip(cmaps, hists)], axis=0), axis=0)
-                blended_color = np.prod(np.stack([cmap(hist) for cmap, hist in zip(cmaps, hists)], axis=0), axis=0)
+                blended_color = _lookup_colors(cmaps[0], hists[0])
+                for cmap, hist in zip(cmaps[1:], hists[1:]):
+                    np.multiply(blended_color, _lookup_colors(cmap, hist), out=blended_color)
             else:
-                color_blend = np.min(np.stack([cmap(hist) for cmap, hist in zip(cmaps_white, hists)], axis=0), axis=0)
-                alpha_blend = np.max(np.stack([cmap(hist) for cmap, hist in zip(cmaps, hists)], axis=0), axis=0)
-                blended_color = color_blend 
-                blended_color[:, :, 3] = alpha_blend[:, :, 3]
+                blended_color = _lookup_colors(cmaps_white[0], hists[0])
+                alpha_blend = _lookup_colors(cmaps[0], hists[0])[:, :, 3]
+                for cmap_white, cmap, hist in zip(cmaps_white[1:], cmaps[1:], hists[1:]):
+                    np.minimum(blended_color, _lookup_colors(cmap_white, hist), out=blended_color)
+                    np.maximum(alpha_blend, _lookup_colors(cmap, hist)[:, :, 3], out=alpha_blend)
+                blended_color[:, :, 3] = alpha_blend
 
         else:
-            blended_color = cmaps[0](np.max(hists, axis=0))
+            # a single color, so use the max over groups (or the one histogram) directly
+            blended_color = _lookup_colors(cmaps[0], hists[0] if len(hists) == 1 else np.max(hists, axis=0))
 
 
         # Make a transparent background
@@ -231,6 +250,30 @@ def plot_intensity_coord_histogram(ax, intensities_1, intensities_2, max,  cmap=
     if show_colorbar:
         add_multiple_colorbars( ax, cmaps)
 
+def _make_cmap(name, background, color):
+    """
+    Get a colormap that goes linearly from background to color. These are cached, so repeated plots
+    with the same colors reuse the colormaps and their lookup tables
+    """
+    # colors can be strings or sequences, which need to be tuples to be hashable
+    return _make_cached_cmap(name, background, color if isinstance(color, str) else tuple(color))
+
+@lru_cache(maxsize=64)
+def _make_cached_cmap(name, background, color):
+    return LinearSegmentedColormap.from_list(name, [background, color])
+
+def _lookup_colors(cmap, values):
+    """
+    Map values in [0, 1] to RGBA colors by indexing the colormap's lookup table directly. This gives
+    the same colors as cmap(values), including the "bad" color for non-finite values (e.g. the histogram 
+    of a group with no points in range). The colors are float32, which is plenty for display
+    """
+    lut = cmap(np.arange(cmap.N)).astype(np.float32)
+    finite = np.isfinite(values)
+    colors = lut[np.clip((np.where(finite, values, 0) * cmap.N).astype(int), 0, cmap.N - 1)]
+    colors[~finite] = cmap(np.nan)
+    return colors
+
 def add_multiple_colorbars(ax, cmaps):
     """
     Add multiple colorbars to the given axis, each corresponding to a different colormap.
@@ -289,6 +332,9 @@ class OverlayedHistograms:
         self.labels = []
         self.log = log
         self.logx = logx
+        # histogram counts of each set of values, valid for the bins in self._cached_bins
+        self._cached_bins = None
+        self._cached_counts = {}
 
     def add(self, values, label=None):
         """
@@ -322,13 +368,26 @@ class OverlayedHistograms:
         """
         Generate logarithmic or linear bin edges based on the values added.
         """
-        min_value = np.array([np.min(e) for e in self.all_values]).min()
-        max_value = np.array([np.max(e) for e in self.all_values]).max()
+        min_value = min(float(np.min(e)) for e in self.all_values)
+        max_value = max(float(np.max(e)) for e in self.all_values)
         if self.logx:
-            self.bins = np.logspace(np.log(min_value), np.log(max_value), self.num_bins, base=np.e)
+            self.bins = np.geomspace(min_value, max_value, self.num_bins)
         else:
             self.bins = np.linspace(min_value, max_value, self.num_bins)
         return self.bins
+
+    def _get_cached_hist_counts(self, index):
+        """
+        Get the histogram counts of the index-th set of values, only recomputing them if the bins have changed.
+        """
+        if self._cached_bins is not self.bins:
+            self._cached_bins = self.bins
+            self._cached_counts = {}
+            self._left = self.bins[:-1]
+            self._widths = np.diff(self.bins)
+        if index not in self._cached_counts:
+            self._cached_counts[index] = self.get_hist_counts(self.all_values[index])
+        return self._cached_counts[index]
         
 
     def plot(self, zorder=None, bottom=.5, **kwargs):
@@ -346,16 +405,16 @@ class OverlayedHistograms:
         """
         if self.bins is None or isinstance(self.bins, int):
             self.generate_bins()
-        for eigenvalues, label in zip(self.all_values, self.labels):
+        for index, label in enumerate(self.labels):
             
 
 
             # _ = self.ax.hist(eigenvalues, bins=self.bins, log=self.log, label=label, alpha=0.5, 
             #                  zorder=zorder[label] if zorder is not None else 1, bottom=bottom,
             #                  **kwargs)   
-            counts = np.histogram(eigenvalues, bins=self.bins)[0]
+            counts = self._get_cached_hist_counts(index).copy()
             counts[counts == 0] = bottom
-            _ = self.ax.bar(self.bins[:-1], counts - bottom, width=np.diff(self.bins), log=self.log, label=label, alpha=0.5, 
+            _ = self.ax.bar(self._left, counts - bottom, width=self._widths, log=self.log, label=label, alpha=0.5, 
                 zorder=zorder[label] if zorder is not None else 1, bottom=bottom,
                 **kwargs)
                               
@@ -0,0 +1,18 @@
+import math
+
+import numpy as np
+from encoding_information.models import AnalyticGaussianNoiseModel, UniformNoiseModel
+
+
+def test_gaussian_entropy():
+    sigma = 0.5
+    entropy = AnalyticGaussianNoiseModel(sigma, num_channels=2).estimate_conditional_entropy()
+    assert np.isclose(entropy, 2 * 0.5 * np.log(2 * np.pi * np.e * sigma**2))
+
+def test_gaussian_entropy_zero_sigma():
+    assert AnalyticGaussianNoiseModel(0).estimate_conditional_entropy() == -math.inf
+
+def test_uniform_entropy_degenerate_range():
+    assert np.isclose(UniformNoiseModel(0, 4).estimate_conditional_entropy(), np.log(4))
+    assert UniformNoiseModel(1, 1).estimate_conditional_entropy() == -math.inf
+    assert math.isnan(UniformNoiseModel(1, 0).estimate_conditional_entropy())
@@ -0,0 +1,126 @@
+import pytest
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+from encoding_information.models import StationaryGaussianProcess
+from encoding_information.models.gaussian_process import (plugin_estimate_stationary_cov_mat,
+                                                          generate_stationary_gaussian_process_samples,
+                                                          _compute_stationary_log_likelihood,
+                                                          average_diagonals_to_make_doubly_toeplitz)
+
+PATCH_SIZE = 4
+
+@pytest.fixture
+def images():
+    return np.random.RandomState(0).gamma(3, 3, size=(200, PATCH_SIZE, PATCH_SIZE)).astype(np.float32)
+
+@pytest.fixture
+def cov_mat(images):
+    return plugin_estimate_stationary_cov_mat(jnp.asarray(images), eigenvalue_floor=1e-3, suppress_warning=True)
+
+@pytest.mark.parametrize('prefer_iterative', [False, True])
+def test_float32_sampling_and_likelihood_with_x64(images, cov_mat, prefer_iterative):
+    with jax.enable_x64(True):
+        mean_vec = jnp.ones(PATCH_SIZE**2) * images.mean()
+        samples = generate_stationary_gaussian_process_samples(mean_vec, cov_mat, 3, sample_size=6, seed=0,
+                                                               prefer_iterative_sampling=prefer_iterative)
+        assert samples.shape == (3, 6, 6)
+        assert samples.dtype == jnp.float32
+        assert np.all(np.isfinite(samples))
+
+        log_likelihood = _compute_stationary_log_likelihood(samples, cov_mat, mean_vec, prefer_iterative=prefer_iterative)
+        assert log_likelihood.dtype == jnp.float32
+        assert np.isfinite(log_likelihood)
+
+def test_model_generate_samples_with_x64(images):
+    with jax.enable_x64(True):
+        model = StationaryGaussianProcess(images)
+        samples = model.generate_samples(3, sample_shape=5, seed=0, verbose=False)
+        assert samples.shape == (3, 5, 5)
+        assert np.all(np.isfinite(samples))
+
+def _stationary_cov_mat(patch_size, length_scale=1.5):
+    """
+    Squared exponential covariance of the pixels of a patch, which is exactly doubly toeplitz
+    """
+    y, x = np.meshgrid(np.arange(patch_size), np.arange(patch_size), indexing='ij')
+    coords = np.stack([y.ravel(), x.ravel()], axis=1)
+    squared_distances = np.sum((coords[:, None] - coords[None]) ** 2, axis=-1)
+    return np.exp(-squared_distances / (2 * length_scale**2)) + 0.1 * np.eye(patch_size**2)
+
+def _reference_average_log_likelihood(samples, cov_mat, mean, prefer_iterative):
+    """
+    Stationary log likelihood computed pixel by pixel from explicit conditional gaussians, averaged the same 
+    way as _compute_stationary_log_likelihood (each term divided by the number of pixels in the patch)
+    """
+    patch_size = int(np.sqrt(cov_mat.shape[0]))
+    num_samples, sample_size = samples.shape[0], samples.shape[1]
+    terms = []
+    if not prefer_iterative:
+        centered = samples[:, :patch_size, :patch_size].reshape(num_samples, -1) - mean
+        _, logdet = np.linalg.slogdet(cov_mat)
+        terms.append(-0.5 * (np.sum(centered @ np.linalg.inv(cov_mat) * centered, axis=1) 
+                             + logdet + cov_mat.shape[0] * np.log(2 * np.pi)))
+    for i in range(sample_size):
+        for j in range(sample_size):
+            if not prefer_iterative and i < patch_size and j < patch_size:
+                continue
+            start_i, start_j = max(i - patch_size + 1, 0), max(j - patch_size + 1, 0)
+            window = samples[:, start_i:start_i + patch_size, start_j:start_j + patch_size].reshape(num_samples, -1)
+            index = min(i, patch_size - 1) * patch_size + min(j, patch_size - 1)
+            # condition on the pixels before this one in raster order within the window
+            weights = np.linalg.solve(cov_mat[:index, :index], cov_mat[:index, index]) if index > 0 else np.zeros(0)
+            conditional_mean = mean + (window[:, :index] - mean) @ weights
+            conditional_variance = cov_mat[index, index] - cov_mat[index, :index] @ weights
+            terms.append(-0.5 * ((window[:, index] - conditional_mean)**2 / conditional_variance 
+                                 + np.log(2 * np.pi * conditional_variance)))
+    return np.mean(np.stack(terms) / cov_mat.shape[0])
+
+@pytest.mark.parametrize('sample_size', [3, 5])
+@pytest.mark.parametrize('prefer_iterative', [False, True])
+def test_stationary_log_likelihood_matches_reference(sample_size, prefer_iterative):
+    cov_mat = _stationary_cov_mat(3)
+    mean = 2.0
+    samples = np.random.RandomState(1).normal(mean, 1, size=(10, sample_size, sample_size))
+    with jax.enable_x64(True):
+        log_likelihood = _compute_stationary_log_likelihood(samples, cov_mat, mean, prefer_iterative=prefer_iterative,
+                                                            dtype=jnp.float64)
+    reference = _reference_average_log_likelihood(samples, cov_mat, mean, prefer_iterative)
+    assert np.allclose(log_likelihood, reference, rtol=1e-6)
+
+def test_average_diagonals_matches_reference():
+    patch_size = 3
+    cov_mat = np.random.RandomState(2).normal(size=(patch_size**2, patch_size**2))
+    cov_mat = cov_mat @ cov_mat.T
+    doubly_toeplitz = average_diagonals_to_make_doubly_toeplitz(jnp.asarray(cov_mat), patch_size)
+
+    # average the blocks along each lower block diagonal, then each of those along its diagonals
+    block_means = [np.mean([cov_mat[(b + d) * patch_size:(b + d + 1) * patch_size, b * patch_size:(b + 1) * patch_size]
+                            for b in range(patch_size - d)], axis=0) for d in range(patch_size)]
+    i, j = np.meshgrid(np.arange(patch_size), np.arange(patch_size), indexing='ij')
+    diag_values = np.array([[block[abs(i - j) == k].mean() for k in range(patch_size)] for block in block_means])
+    reference = np.block([[diag_values[abs(bi - bj)][abs(i - j)] for bj in range(patch_size)] for bi in range(patch_size)])
+    assert np.allclose(doubly_toeplitz, reference, rtol=1e-5, atol=1e-5)
+
+@pytest.mark.parametrize('prefer_iterative', [False, True])
+def test_sample_covariance_matches(prefer_iterative):
+    # separable exponential covariance. This is markov, so conditioning on the window is exact and every
+    # window of a larger sample should have the same covariance
+    rows = 0.7 ** np.abs(np.subtract.outer(np.arange(3), np.arange(3)))
+    cov_mat = np.kron(rows, rows)
+    samples = np.asarray(generate_stationary_gaussian_process_samples(np.zeros(9), cov_mat, 20000, sample_size=5, seed=0,
+                                                                      prefer_iterative_sampling=prefer_iterative))
+    for i, j in [(0, 0), (0, 2), (2, 0), (2, 2)]:
+        window = samples[:, i:i + 3, j:j + 3].reshape(samples.shape[0], -1)
+        assert np.abs(window.mean()) < 0.05
+        assert np.allclose(np.cov(window.T), cov_mat, atol=0.05)
+
+def test_validation_rejects_indefinite_cov_mat():
+    vectors = np.random.RandomState(3).normal(size=(9, 3))
+    # slightly indefinite, by less than the jitter added before factoring in float32
+    cov_mat = vectors @ vectors.T - 2e-7 * np.eye(9)
+    with pytest.raises(ValueError):
+        generate_stationary_gaussian_process_samples(np.zeros(9), cov_mat, 2, sample_size=5)
+    with pytest.raises(ValueError):
+        _compute_stationary_log_likelihood(np.zeros((2, 3, 3)), cov_mat, 0.0)